@@ -0,0 +1,103 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import fonts
+from network import parse_url, request
+from html import lex, parse
+from style import style, load_stylesheet
+from layout import Page, BlockLayout
+from graphics import DrawText, DrawRect
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'default.css'), 'r') as f:
+    DEFAULT_STYLE = f.read()
+
+PHASES = ("fetch", "lex", "parse", "style", "layout1", "layout2", "display list")
+
+def load(source):
+    if source.startswith("http://"):
+        host, port, path, fragment = parse_url(source)
+        headers, body = request('GET', host, port, path)
+        return body
+    with open(source, 'r') as f:
+        return f.read()
+
+def serialize(cmd):
+    if isinstance(cmd, DrawText):
+        font = cmd.font
+        return ["text", cmd.x, cmd.y, cmd.text, cmd.color,
+                [font.family, font.size, font.weight, font.slant]]
+    elif isinstance(cmd, DrawRect):
+        return ["rect", cmd.x1, cmd.y1, cmd.x2, cmd.y2]
+    else:
+        return [type(cmd).__name__, cmd.y1, cmd.y2]
+
+def render(source):
+    # fetch -> lex -> parse -> style -> layout -> display list, timing each step
+    timings = {}
+    def step(name, f, *args):
+        start = time.perf_counter()
+        result = f(*args)
+        timings[name] = time.perf_counter() - start
+        return result
+
+    try:
+        body = step("fetch", load, source)
+        tokens = step("lex", lex, body)
+        nodes = step("parse", parse, tokens)
+        step("style", style, nodes, load_stylesheet(DEFAULT_STYLE))
+        layout = BlockLayout(Page(), nodes)
+        step("layout1", layout.layout1)
+        step("layout2", layout.layout2, 0)
+        dl = step("display list", layout.display_list)
+    except Exception as e:
+        return {"source": source, "error": "{}: {}".format(type(e).__name__, e), "timings": timings}
+    return {"source": source, "timings": timings, "height": layout.height(),
+            "display_list": [serialize(cmd) for cmd in dl]}
+
+def init_worker():
+    fonts.set_backend(fonts.HeadlessBackend())
+
+def read_sources(args):
+    sources = []
+    for arg in args:
+        # @file names a file with one URL or path per line
+        if arg.startswith("@"):
+            with open(arg[1:], 'r') as f:
+                sources.extend(line.strip() for line in f if line.strip())
+        else:
+            sources.append(arg)
+    return sources
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Lay out many pages headlessly and dump their display lists.")
+    parser.add_argument("sources", nargs="+", help="URLs, HTML files, or @file with one per line")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("-o", "--output", help="write JSON lines here instead of stdout")
+    parser.add_argument("--timings-only", action="store_true", help="leave display lists out of the output")
+    args = parser.parse_args(argv)
+
+    sources = read_sources(args.sources)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    totals = dict.fromkeys(PHASES, 0.0)
+    errors = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker) as pool:
+        for result in pool.map(render, sources, chunksize=max(1, len(sources) // (4 * args.jobs))):
+            if "error" in result: errors += 1
+            for phase, elapsed in result["timings"].items():
+                totals[phase] += elapsed
+            if args.timings_only: result.pop("display_list", None)
+            out.write(json.dumps(result) + "\n")
+    elapsed = time.perf_counter() - start
+    if out is not sys.stdout: out.close()
+
+    print("{} documents ({} failed) in {:.2f}s with {} workers, {:.1f} documents/s".format(
+        len(sources), errors, elapsed, args.jobs, len(sources) / elapsed if elapsed else 0), file=sys.stderr)
+    for phase in PHASES:
+        print("  {:<13} {:.3f}s".format(phase, totals[phase]), file=sys.stderr)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,157 @@
+import sys
+import time
+import tracemalloc
+import server
+from html import lex, parse, ElementNode
+from style import style, restyle, parse_css, load_stylesheet
+from layout import Page, BlockLayout, InlineLayout
+import fonts
+
+# Benchmarks measure layout, not the windowing system
+fonts.set_backend(fonts.HeadlessBackend())
+
+with open('default.css', 'r') as f:
+    DEFAULT_STYLE = f.read()
+
+def count_nodes(node):
+    count = 1
+    for child in getattr(node, "children", ()):
+        count += count_nodes(child)
+    return count
+
+def guest_book(entries):
+    server.ENTRIES[:] = ["Entry number {} says hello".format(i) for i in range(entries)]
+    return server.handle_request("GET", "/", {}, None)
+
+def bench_nodes(entries=20000):
+    tokens = lex(guest_book(entries))
+    rules = parse_css(DEFAULT_STYLE)
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    tree = parse(tokens)
+    parsed = tracemalloc.get_traced_memory()[0]
+    style(tree, rules)
+    styled = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    n = count_nodes(tree)
+    print("nodes: {}".format(n))
+    print("parsed: {:.1f} bytes/node".format((parsed - start) / n))
+    print("styled: {:.1f} bytes/node".format((styled - start) / n))
+
+# A section of a typical site stylesheet, with what default.css lacks:
+# at-rules, comments, comma lists, !important and quoted punctuation
+SITE_CSS = """
+/* ---- section %i ---- */
+html, body { margin: 0; padding: 0; font-family: "Helvetica Neue", Arial, sans-serif; }
+.container-%i, #main-%i { max-width: 960px; margin: 0 auto; }
+nav a:hover, .nav-%i { color: #336699 !important; text-decoration: underline; }
+.quote-%i { content: "\\201C; {"; quotes: '"' '"'; }
+.icon-%i { background: url(data:image/png;base64,iVBORw0KGgo=) no-repeat; width: 16px; }
+@font-face { font-family: "Site %i"; src: url("site.woff2") format("woff2"), url(site.woff); }
+@media (max-width: 600px) {
+  .container-%i { padding: 0 8px; }
+  @supports (display: grid) { .grid-%i { display: grid; } }
+}
+@keyframes fade-%i { from { opacity: 0; } to { opacity: 1; } }
+footer, .footer-%i { color: #777; /* muted */ font-size: 12px; }
+"""
+
+def site_stylesheet(sections=2000):
+    return '@charset "utf-8";\n@import url("print.css") print;\n' + DEFAULT_STYLE + \
+        "".join(SITE_CSS.replace("%i", str(i)) for i in range(sections))
+
+def bench_css(path=None, sections=2000):
+    # "python bench.py css=site.css" measures a saved stylesheet instead
+    if path:
+        with open(path, 'r') as f:
+            source = f.read()
+    else:
+        source = site_stylesheet(sections)
+    start = time.perf_counter()
+    rules = parse_css(source)
+    elapsed = time.perf_counter() - start
+    print("stylesheet: {} bytes, {} rules".format(len(source), len(rules)))
+    print("parse_css: {:.3f}s".format(elapsed))
+
+def forum_page(posts):
+    server.FORUM["Cars"] = [("Post {} about the flux capacitor".format(i), "User{}".format(i), i % 2 == 0)
+                            for i in range(posts)]
+    return server.handle_request("GET", "/Cars", {}, None)
+
+def find_tag(node, tag, out):
+    if not isinstance(node, ElementNode): return out
+    if node.tag == tag: out.append(node)
+    for child in node.children:
+        find_tag(child, tag, out)
+    return out
+
+def find_inline(layout, out):
+    if isinstance(layout, InlineLayout): out.append(layout)
+    for child in getattr(layout, "children", ()):
+        find_inline(child, out)
+    return out
+
+def bench_edit(posts=2000, edits=20):
+    nodes = parse(lex(forum_page(posts)))
+    rules = load_stylesheet(DEFAULT_STYLE)
+    field = [elt for elt in find_tag(nodes, "input", []) if elt.attributes.get("name") == "user"][0]
+    # Put a field near the top too, so edits there shift everything below
+    top = find_tag(nodes, "pre", [])[0]
+
+    start = time.perf_counter()
+    restyle(nodes, rules)
+    page = Page()
+    layout = BlockLayout(page, nodes)
+    layout.layout1()
+    layout.layout2(0)
+    layout.display_list()
+    full = time.perf_counter() - start
+
+    def edit(node, i):
+        if node is field:
+            node.set_attribute("value", "edit {}".format(i))
+        else:
+            node.set_children(node.children)
+        start = time.perf_counter()
+        restyle(nodes, rules)
+        page.children = []
+        layout.layout1()
+        layout.layout2(0)
+        layout.display_list()
+        return time.perf_counter() - start
+
+    bottom_edit = min(edit(field, i) for i in range(edits))
+    top_edit = min(edit(top, i) for i in range(edits))
+    print("nodes: {}".format(count_nodes(nodes)))
+    print("full layout + display list: {:.4f}s".format(full))
+    print("edit last field: {:.4f}s".format(bottom_edit))
+    print("edit first post: {:.4f}s".format(top_edit))
+
+def paragraphs(count, words):
+    text = " ".join("word{}".format(i % 97) * (1 + i % 3) for i in range(words))
+    return "<html><body>" + "".join("<p>{}</p>".format(text) for _ in range(count)) + "</body></html>"
+
+def bench_text(count=20, words=5000):
+    nodes = parse(lex(paragraphs(count, words)))
+    restyle(nodes, load_stylesheet(DEFAULT_STYLE))
+    layout = BlockLayout(Page(), nodes)
+    start = time.perf_counter()
+    layout.layout1()
+    elapsed = time.perf_counter() - start
+    layout.layout2(0)
+    print("words: {}".format(count * words))
+    print("lines: {}".format(sum(len(child.children) for child in find_inline(layout, []))))
+    print("layout1: {:.4f}s".format(elapsed))
+
+BENCHMARKS = {
+    "nodes": bench_nodes,
+    "css": bench_css,
+    "edit": bench_edit,
+    "text": bench_text,
+}
+
+if __name__ == "__main__":
+    for arg in sys.argv[1:] or BENCHMARKS:
+        name, _, value = arg.partition("=")
+        print("==", arg)
+        BENCHMARKS[name](*[value] if value else [])
@@ -0,0 +1,163 @@
+import collections
+import email.utils
+import hashlib
+import json
+import os
+import threading
+import time
+
+MAX_CACHE_BYTES = 32 * 1024 * 1024
+
+def http_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def cache_control(headers):
+    out = {}
+    for directive in headers.get("cache-control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name: out[name.lower()] = value.strip('"')
+    return out
+
+class CacheEntry:
+    def __init__(self, url, headers, body, stored, last_used=None):
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.stored = stored
+        self.last_used = last_used or stored
+        self.size = len(body) + sum(len(k) + len(v) for k, v in headers.items())
+
+    def lifetime(self):
+        cc = cache_control(self.headers)
+        if "no-cache" in cc: return 0
+        if "max-age" in cc:
+            try:
+                return int(cc["max-age"])
+            except ValueError:
+                return 0
+        expires = http_date(self.headers.get("expires"))
+        if expires is None: return 0
+        date = http_date(self.headers.get("date")) or self.stored
+        return expires - date
+
+    def age(self, now):
+        try:
+            initial = int(self.headers.get("age", "0"))
+        except ValueError:
+            initial = 0
+        return initial + now - self.stored
+
+    def is_fresh(self, now):
+        return self.age(now) < self.lifetime()
+
+    def validators(self):
+        out = {}
+        if "etag" in self.headers:
+            out["If-None-Match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            out["If-Modified-Since"] = self.headers["last-modified"]
+        return out
+
+    def to_json(self):
+        return {"url": self.url, "headers": self.headers, "body": self.body,
+                "stored": self.stored, "last_used": self.last_used}
+
+def storable(headers):
+    cc = cache_control(headers)
+    if "no-store" in cc or headers.get("vary", "").strip() == "*":
+        return False
+    # Without a freshness lifetime or a validator the entry could never be reused
+    return "max-age" in cc or "expires" in headers or \
+        "etag" in headers or "last-modified" in headers
+
+class HTTPCache:
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = collections.OrderedDict()  # least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.load()
+
+    def key(self, host, port, path):
+        return "http://{}:{}{}".format(host, port, path)
+
+    def path_for(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode("utf8")).hexdigest() + ".json")
+
+    def load(self):
+        loaded = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"): continue
+            try:
+                with open(os.path.join(self.directory, name), "r") as f:
+                    data = json.load(f)
+                entry = CacheEntry(data["url"], data["headers"], data["body"],
+                                   data["stored"], data["last_used"])
+            except (OSError, ValueError, KeyError, TypeError, AttributeError):
+                # Damaged or from an older format; it is just a cache
+                continue
+            loaded.append(entry)
+        loaded.sort(key=lambda entry: entry.last_used)
+        for entry in loaded:
+            self.insert(entry, write=False)
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+                entry.last_used = time.time()
+            return entry
+
+    def store(self, url, headers, body):
+        if not storable(headers):
+            self.remove(url)
+            return
+        entry = CacheEntry(url, headers, body, time.time())
+        with self.lock:
+            self.insert(entry, write=True)
+
+    def freshen(self, entry, headers):
+        # A 304 carries updated metadata for the stored body
+        merged = dict(entry.headers)
+        for header in ("cache-control", "expires", "date", "etag", "last-modified", "age"):
+            if header in headers: merged[header] = headers[header]
+        self.store(entry.url, merged, entry.body)
+
+    def insert(self, entry, write):
+        # Caller holds self.lock (or is still constructing the cache)
+        if entry.size > self.max_bytes: return
+        old = self.entries.pop(entry.url, None)
+        if old is not None: self.size -= old.size
+        self.entries[entry.url] = entry
+        self.size += entry.size
+        if write and self.directory is not None:
+            # Written aside and renamed, so a crash never leaves half an entry
+            path = self.path_for(entry.url)
+            with open(path + ".tmp", "w") as f:
+                json.dump(entry.to_json(), f)
+            os.replace(path + ".tmp", path)
+        while self.size > self.max_bytes:
+            url, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+            self.unlink(url)
+
+    def remove(self, url):
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry is None: return
+            self.size -= entry.size
+            self.unlink(url)
+
+    def unlink(self, url):
+        if self.directory is None: return
+        try:
+            os.remove(self.path_for(url))
+        except OSError:
+            pass
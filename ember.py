@@ -1,11 +1,17 @@
 import tkinter
 import tkinter.font
+import collections
+import os
+import concurrent.futures
+import time
 import dukpy
-from network import parse_url, request
-from html import lex, parse
-from style import style, parse_css
-from layout import BlockLayout, is_checkbox, is_checked
-from html import ElementNode
+from network import parse_url, request, request_stream, MAX_CONNECTIONS_PER_HOST
+from html import Lexer, TreeBuilder
+from style import restyle, load_stylesheet, css_selector
+from layout import Page, BlockLayout, HitIndex, is_checkbox, is_checked
+from html import ElementNode, TextNode
+from fonts import METRICS
+from graphics import DisplayList, RetainedRenderer, optimize
 from timing import Timer
 
 with open('default.css', 'r') as f:
@@ -14,29 +20,6 @@ with open('default.css', 'r') as f:
 with open('runtime.js', 'r') as f:
     DEFAULT_JS = f.read()
 
-class Page:
-    def __init__(self):
-        self.x = 13
-        self.y = 13
-        self.w = 774
-        self.children = []
-
-    def content_left(self):
-        return self.x
-    def content_top(self):
-        return self.y
-    def content_width(self):
-        return self.w
-
-def find_element(x, y, layout):
-    if hasattr(layout, "children"):
-        for child in layout.children:
-            result = find_element(x, y, child)
-            if result: return result
-    if hasattr(layout, "node") and layout.x <= x < layout.x + layout.w and \
-       layout.y <= y < layout.y + layout.height():
-        return layout.node
-
 def is_layout(c):
     return (isinstance(c, TextLayout) or
             isinstance(c, LineLayout) or
@@ -47,9 +30,9 @@ def is_layout(c):
 def edit_input(elt):
     new_text = input("Enter new text: ")
     if elt.tag == "input":
-        elt.attributes["value"] = new_text
+        elt.set_attribute("value", new_text)
     else:
-        elt.children = [TextNode(elt, new_text)]
+        elt.set_children([TextNode(elt, new_text)])
 
 def find_inputs(elt, out):
     if not isinstance(elt, ElementNode): return
@@ -80,22 +63,67 @@ def relative_url(url, current):
     else:
         return 'http://' + current.rsplit("/", 1)[0] + "/" + url
 
-def find_scripts(node, out):
-    if not isinstance(node, ElementNode): return
-    if node.tag == "script" and \
-       "src" in node.attributes:
-        out.append(node.attributes["src"])
-    for child in node.children:
-        find_scripts(child, out)
-    return out
+def fetch(url):
+    host, port, path, fragment = parse_url(url)
+    headers, body = request('GET', host, port, path)
+    return body
+
+def count_tree(node):
+    count = 1
+    for child in getattr(node, "children", ()):
+        count += count_tree(child)
+    return count
+
+BFCACHE_ENTRIES = 8
+BFCACHE_BUDGET = 500000 # nodes + layout objects + draw commands
+
+class PageSnapshot:
+    FIELDS = ("url", "headers", "nodes", "rules", "js", "js_handles",
+              "page", "layout", "layout_until", "hits", "maxh", "display_list", "scrolly")
+
+    def __init__(self, browser):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(browser, field))
+        self.size = count_tree(self.nodes) + count_tree(self.layout) + len(self.display_list)
+
+    def restore(self, browser):
+        for field in self.FIELDS:
+            setattr(browser, field, getattr(self, field))
+
+class BackForwardCache:
+    def __init__(self, max_entries=BFCACHE_ENTRIES, budget=BFCACHE_BUDGET):
+        self.max_entries = max_entries
+        self.budget = budget
+        self.entries = collections.OrderedDict() # history entry -> PageSnapshot, oldest first
+        self.size = 0
+
+    def put(self, entry, snapshot):
+        self.pop(entry)
+        if snapshot.size > self.budget: return
+        self.entries[entry] = snapshot
+        self.size += snapshot.size
+        while len(self.entries) > self.max_entries or self.size > self.budget:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def pop(self, entry):
+        snapshot = self.entries.pop(entry, None)
+        if snapshot is not None:
+            self.size -= snapshot.size
+        return snapshot
 
 SCROLL_STEP = 100
+# Milliseconds between the layout steps that finish a page below the fold
+LAYOUT_INTERVAL = 10
+METRICS_FILE = os.path.join(os.path.expanduser("~"), ".ember-metrics.json")
+PAINT_INTERVAL = 0.25 # seconds between paints of a page still loading
 
 class Browser:
     def __init__(self):
         self.window = tkinter.Tk()
         self.canvas = tkinter.Canvas(self.window, width=800, height=600)
         self.canvas.pack()
+        self.renderer = RetainedRenderer(self.canvas, 600)
         self.window.bind("<Down>", self.scrolldown)
         self.window.bind("<Up>", self.scrollup)
         self.window.bind("<Button-1>", self.handle_click)
@@ -104,6 +132,16 @@ class Browser:
         self.scrolly = 0
         self.maxh = 0
         self.timer=Timer()
+        self.bfcache = BackForwardCache()
+        self.layout = None
+        self.hits = None
+        # Layout is done down to this y, and continued in after() callbacks
+        self.layout_until = 0
+        self.layout_pending = False
+        # The history entry whose page is on screen
+        self.current_entry = None
+        # Subresources download in parallel, up to the pool's per-host limit
+        self.fetcher = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONNECTIONS_PER_HOST)
 
     def go_back(self, e):
         if len(self.history) < 2:
@@ -124,32 +162,70 @@ class Browser:
                     return
             else:
                 self.browse(current, 'get', post)
-        self.browse(last, s_type2, post2)
+        self.restore(last, s_type2, post2)
+
+    def save_page(self):
+        if self.current_entry is None or not hasattr(self, "display_list"): return
+        self.bfcache.put(self.current_entry, PageSnapshot(self))
+
+    def restore(self, url, s_type=None, post=None):
+        snapshot = self.bfcache.pop((url, s_type, post))
+        if snapshot is None:
+            self.browse(url, s_type, post)
+            return
+        self.save_page()
+        snapshot.restore(self)
+        self.current_entry = (url, s_type, post)
+        self.history.append(self.current_entry)
+        self.render()
+        self.continue_layout_later()
 
     def browse(self, url, s_type=None, post=None):
+        self.save_page()
         try:
             host, port, path, fragment = parse_url(url)
             self.timer.start("Downloading")
-            headers, body = request('GET', host, port, path)
+            # The body is lexed as it arrives in parse
+            headers, body = request_stream('GET', host, port, path)
             self.timer.stop()
         except AssertionError:
             return
         self.headers = headers
         self.body = body
         self.url = url
-        self.history.append((url, s_type, post))
+        self.current_entry = (url, s_type, post)
+        self.history.append(self.current_entry)
         self.scrolly = 0
         self.parse()
 
     def parse(self):
-        self.timer.start("HTML")
-        self.text = lex(self.body)
-        self.timer.stop()
-        self.nodes = parse(self.text)
         self.timer.start("Parse CSS")
-        self.rules = parse_css(DEFAULT_STYLE)
+        self.rules = load_stylesheet(DEFAULT_STYLE)
         self.timer.stop()
-        self.rules.sort(key=lambda x: x[0].score())
+        # Tokens go straight into the tree as chunks arrive, and the top of
+        # the page is painted before the rest of it has been downloaded
+        # Scripts start downloading as soon as their tags are parsed; scripts
+        # stays in document order, which is the order they are evaluated in
+        scripts = []
+        def discover(elt):
+            if elt.tag == "script" and "src" in elt.attributes:
+                url = relative_url(elt.attributes["src"], self.history[-1][0])
+                scripts.append(self.fetcher.submit(fetch, url))
+        lexer = Lexer()
+        builder = TreeBuilder(discover)
+        last_paint = None
+        for chunk in [self.body] if isinstance(self.body, str) else self.body:
+            self.timer.start("HTML")
+            builder.feed(lexer.feed(chunk))
+            self.timer.stop()
+            if builder.root is not None and \
+               (last_paint is None or time.monotonic() - last_paint > PAINT_INTERVAL):
+                self.nodes = builder.root
+                self.relayout()
+                self.canvas.update_idletasks()
+                last_paint = time.monotonic()
+        builder.feed(lexer.close())
+        self.nodes = builder.close()
         self.timer.start("JS")
         self.js = dukpy.JSInterpreter()
         self.js_handles = dict()
@@ -161,10 +237,8 @@ class Browser:
         # Run runtime
         self.js.evaljs(DEFAULT_JS)
         
-        for script in find_scripts(self.nodes, []):
-            lhost, lport, lpath, lfragment = parse_url(relative_url(script, self.history[-1]))
-            header, body = request('GET', lhost, lport, lpath)
-            self.js.evaljs(body)
+        for script in scripts:
+            self.js.evaljs(script.result())
         self.timer.stop()
         self.relayout()
 
@@ -186,43 +260,74 @@ class Browser:
     
     def relayout(self):
         self.timer.start("Style")
-        style(self.nodes, self.rules)
+        restyle(self.nodes, self.rules)
         self.timer.stop()
 
-        self.page = Page()
-        self.layout = BlockLayout(self.page, self.nodes)
+        # Layout objects survive between passes; only dirty subtrees are redone
+        if self.layout is None or self.layout.node is not self.nodes:
+            self.page = Page()
+            self.layout = BlockLayout(self.page, self.nodes)
+            self.layout_until = 0
+        # Lay out the screen being looked at first; the rest follows in the background
+        self.layout_until = max(self.layout_until, self.scrolly + 600)
+        self.lay_out()
+        self.render()
+        self.continue_layout_later()
+
+    def lay_out(self):
+        self.page.children = []
         self.timer.start("Layout1")
-        self.layout.layout1()
+        self.layout.layout1(self.layout_until)
         self.timer.stop()
         self.timer.start("Layout2")
         self.layout.layout2(0)
         self.timer.stop()
         self.maxh = self.layout.height()
         self.timer.start("Display list")
-        self.display_list = self.layout.display_list()
+        self.display_list = DisplayList(optimize(self.layout.display_list()))
+        # Built on the first click or hover after this layout
+        self.hits = None
         self.timer.stop()
+
+    def continue_layout_later(self):
+        if self.layout.partial and not self.layout_pending:
+            self.layout_pending = True
+            self.window.after(LAYOUT_INTERVAL, self.continue_layout)
+
+    def continue_layout(self):
+        self.layout_pending = False
+        if not self.layout.partial: return
+        # Each step covers as much again as all the ones before it
+        self.layout_until *= 2
+        self.lay_out()
         self.render()
+        self.continue_layout_later()
 
     def render(self):
         #self.timer.start("Render")
-        self.canvas.delete("all")
-        for cmd in self.display_list:
-            if cmd.y2 - self.scrolly < -20: continue
-            if cmd.y2 - self.scrolly > 600 + 20: continue
-            cmd.draw(self.scrolly, self.canvas)
+        self.renderer.render(self.display_list, self.scrolly)
         #self.timer.stop()
 
     def scrolldown(self, e):
         self.scrolly = min(self.scrolly + SCROLL_STEP, 13 + self.maxh - 600)
+        if self.layout.partial and self.scrolly + 600 > self.layout_until:
+            # Scrolled past the laid out part before the background caught up
+            self.layout_until = self.scrolly + 1200
+            self.lay_out()
         self.render()
 
     def scrollup(self, e):
         self.scrolly = max(self.scrolly - SCROLL_STEP, 0)
         self.render()
     
+    def hit_test(self, x, y):
+        if self.hits is None:
+            self.hits = HitIndex(self.layout)
+        return self.hits.find(x, y)
+
     def handle_click(self, e):
         x, y = e.x, e.y + self.scrolly
-        elt = find_element(x, y, self.layout)
+        elt = self.hit_test(x, y)
         while elt and not \
               (isinstance(elt, ElementNode) and ((elt.tag == "a" and "href" in elt.attributes)
                                                  or elt.tag in ("input", "textarea", "button"))):
@@ -237,9 +342,9 @@ class Browser:
         elif elt.tag in ("input", "textarea"):
             if is_checkbox(elt): # EX 1
                 if is_checked(elt):
-                    del elt.attributes["checked"]
+                    elt.remove_attribute("checked")
                 else:
-                    elt.attributes["checked"] = ""
+                    elt.set_attribute("checked", "")
             else:
                 edit_input(elt)
             self.relayout()
@@ -293,13 +398,17 @@ class Browser:
         return body
 
     def send_post(self, url, body):
+        self.save_page()
         host, port, path, fragment = parse_url(url)
-        self.headers, self.body = request('POST', host, port, path, body)
-        self.history.append((url, 'post', body))
+        self.headers, self.body = request_stream('POST', host, port, path, body)
+        self.current_entry = (url, 'post', body)
+        self.history.append(self.current_entry)
         self.parse()
 
 if __name__ == "__main__":
     import sys
+    # Text widths measured in earlier sessions
+    METRICS.load(METRICS_FILE)
     browser = Browser()
     if len(sys.argv) > 1:
         browser.browse(sys.argv[1])
@@ -307,3 +416,4 @@ if __name__ == "__main__":
         #browser.browse("http://pavpanchekha.com/blog/emberfox/chrome.html")
         browser.browse("http://kepler.cs.utah.edu:9000")
     tkinter.mainloop()
+    METRICS.save(METRICS_FILE)
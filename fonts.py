@@ -0,0 +1,173 @@
+import array
+import collections
+import json
+
+MAX_CACHED_WORDS = 100000
+
+class TkBackend:
+    def make_font(self, family, size, weight, slant):
+        # Needs a Tk root, so tkinter is only touched once a font is asked for
+        import tkinter.font
+        return tkinter.font.Font(family=family, size=size, weight=weight, slant=slant)
+
+# Advance widths of Times Roman in 1/1000 em, for ' ' through '~'
+TIMES_ADVANCES = [
+    250, 333, 408, 500, 500, 833, 778, 180, 333, 333, 500, 564, 250, 333, 250, 278,
+    500, 500, 500, 500, 500, 500, 500, 500, 500, 500, 278, 278, 564, 564, 564, 444,
+    921, 722, 667, 667, 722, 611, 556, 722, 722, 333, 389, 722, 611, 889, 722, 722,
+    556, 722, 667, 556, 611, 722, 722, 944, 722, 722, 611, 333, 278, 333, 469, 500,
+    333, 444, 500, 444, 500, 444, 333, 500, 500, 278, 278, 500, 278, 778, 500, 500,
+    500, 500, 333, 389, 278, 500, 500, 722, 500, 500, 444, 480, 200, 480, 541,
+]
+DEFAULT_ADVANCE = 500
+BOLD_SCALE = 1.05
+
+class HeadlessFont:
+    # Enough of tkinter.font.Font for layout: measure and metrics
+    def __init__(self, family, size, weight, slant):
+        self.family = family
+        self.size = size
+        self.weight = weight
+        self.slant = slant
+        # Tk sizes are points; assume 96 dpi
+        self.em = size * 96 / 72 * (BOLD_SCALE if weight == "bold" else 1)
+        self.widths = [round(self.em * advance / 1000) for advance in TIMES_ADVANCES]
+        self.default = round(self.em * DEFAULT_ADVANCE / 1000)
+
+    def measure(self, text):
+        widths = self.widths
+        total = 0
+        for c in text:
+            i = ord(c) - 32
+            total += widths[i] if 0 <= i < len(widths) else self.default
+        return total
+
+    def metrics(self, *options):
+        metrics = {"ascent": round(self.em * 0.9), "descent": round(self.em * 0.25), "fixed": 0}
+        metrics["linespace"] = metrics["ascent"] + metrics["descent"]
+        return metrics[options[0]] if options else metrics
+
+class HeadlessBackend:
+    def make_font(self, family, size, weight, slant):
+        return HeadlessFont(family, size, weight, slant)
+
+BACKEND = TkBackend()
+FONTS = dict()   # (family, size, weight, slant) -> font from BACKEND
+
+def get_font(family="Times", size=16, weight="normal", slant="roman"):
+    key = (family, size, weight, slant)
+    font = FONTS.get(key)
+    if font is None:
+        font = FONTS[key] = BACKEND.make_font(family, size, weight, slant)
+    return font
+
+class MetricsCache:
+    def __init__(self, max_words=MAX_CACHED_WORDS, approximate=False):
+        self.max_words = max_words
+        # Sum per-character widths for unseen words instead of asking Tk
+        self.approximate = approximate
+        self.fonts = dict()                     # font key -> (linespace, space width)
+        self.words = collections.OrderedDict()  # font key + (text,) -> width, least recent first
+        self.chars = dict()                     # font key -> {character: width}
+        self.hits = 0
+        self.misses = 0
+
+    def font_metrics(self, family, size, weight, slant):
+        key = (family, size, weight, slant)
+        metrics = self.fonts.get(key)
+        if metrics is None:
+            font = get_font(family, size, weight, slant)
+            metrics = self.fonts[key] = (font.metrics("linespace"), font.measure(" "))
+        return metrics
+
+    def char_width(self, key, c):
+        table = self.chars.get(key)
+        if table is None:
+            table = self.chars[key] = dict()
+        width = table.get(c)
+        if width is None:
+            width = table[c] = get_font(*key).measure(c)
+        return width
+
+    def measure(self, family, size, weight, slant, text):
+        key = (family, size, weight, slant, text)
+        width = self.words.get(key)
+        if width is not None:
+            self.hits += 1
+            self.words.move_to_end(key)
+            return width
+        self.misses += 1
+        if self.approximate:
+            width = sum(self.char_width(key[:4], c) for c in text)
+        else:
+            width = get_font(family, size, weight, slant).measure(text)
+        self.words[key] = width
+        if len(self.words) > self.max_words:
+            self.words.popitem(last=False)
+        return width
+
+    def measure_all(self, family, size, weight, slant, texts):
+        # One call per text run instead of one per word; misses go through measure
+        words = self.words
+        out = array.array("l")
+        for text in texts:
+            key = (family, size, weight, slant, text)
+            width = words.get(key)
+            if width is None:
+                width = self.measure(family, size, weight, slant, text)
+            else:
+                self.hits += 1
+                words.move_to_end(key)
+            out.append(width)
+        return out
+
+    def clear(self):
+        self.fonts.clear()
+        self.words.clear()
+        self.chars.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "words": len(self.words),
+                "fonts": len(self.fonts)}
+
+    def save(self, path):
+        data = {"fonts": [list(key) + list(metrics) for key, metrics in self.fonts.items()],
+                "words": [list(key) + [width] for key, width in self.words.items()],
+                "chars": [list(key) + [table] for key, table in self.chars.items()]}
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    def load(self, path):
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        for family, size, weight, slant, linespace, space in data.get("fonts", []):
+            self.fonts[(family, size, weight, slant)] = (linespace, space)
+        for family, size, weight, slant, text, width in data.get("words", []):
+            self.words[(family, size, weight, slant, text)] = width
+        for family, size, weight, slant, table in data.get("chars", []):
+            self.chars[(family, size, weight, slant)] = table
+        while len(self.words) > self.max_words:
+            self.words.popitem(last=False)
+
+METRICS = MetricsCache()
+
+def font_metrics(family="Times", size=16, weight="normal", slant="roman"):
+    return METRICS.font_metrics(family, size, weight, slant)
+
+def measure(text, family="Times", size=16, weight="normal", slant="roman"):
+    return METRICS.measure(family, size, weight, slant, text)
+
+def measure_all(texts, family="Times", size=16, weight="normal", slant="roman"):
+    return METRICS.measure_all(family, size, weight, slant, texts)
+
+def set_backend(backend):
+    # Fonts and every cached measurement belong to the old backend
+    global BACKEND
+    BACKEND = backend
+    FONTS.clear()
+    METRICS.clear()
@@ -1,5 +1,5 @@
 class DrawText:
-    def __init__(self, x, y, text, font, color, height):
+    def __init__(self, x, y, text, font, color, height, width=None):
         self.x = x
         self.y = y
         self.y1 = y
@@ -7,9 +7,16 @@ class DrawText:
         self.text = text
         self.font = font
         self.color = color
+        # Known for laid-out words; lets optimize() join neighbouring runs
+        self.w = width
         
+    def shift(self, dy):
+        self.y += dy
+        self.y1 += dy
+        self.y2 += dy
+
     def draw(self, scrolly, canvas):
-        canvas.create_text(self.x, self.y - scrolly, text=self.text, font=self.font, anchor='nw', fill = self.color)
+        return canvas.create_text(self.x, self.y - scrolly, text=self.text, font=self.font, anchor='nw', fill = self.color)
 
 class DrawRect:
     def __init__(self, x1, y1, x2, y2):
@@ -18,5 +25,130 @@ class DrawRect:
         self.x2 = x2
         self.y2 = y2
 
+    def shift(self, dy):
+        self.y1 += dy
+        self.y2 += dy
+
     def draw(self, scrolly, canvas):
-        canvas.create_rectangle(self.x1, self.y1 - scrolly, self.x2, self.y2 - scrolly)
+        return canvas.create_rectangle(self.x1, self.y1 - scrolly, self.x2, self.y2 - scrolly)
+
+class DrawOutline:
+    # A border of equal width on all four sides, as one canvas item
+    def __init__(self, x1, y1, x2, y2, width):
+        self.x1 = x1
+        self.y1 = y1
+        self.x2 = x2
+        self.y2 = y2
+        self.width = width
+
+    def shift(self, dy):
+        self.y1 += dy
+        self.y2 += dy
+
+    def draw(self, scrolly, canvas):
+        # Tk centres the outline on the rectangle's edge
+        half = self.width / 2
+        return canvas.create_rectangle(self.x1 + half, self.y1 - scrolly + half,
+                                       self.x2 - half, self.y2 - scrolly - half, width=self.width)
+
+def is_frame(left, right, top, bottom):
+    # The four DrawRects BlockLayout emits for a box with uniform borders
+    width = left.x2 - left.x1
+    return left.x1 == top.x1 == bottom.x1 and right.x2 == top.x2 == bottom.x2 and \
+        left.y1 == right.y1 == top.y1 and left.y2 == right.y2 == bottom.y2 and \
+        right.x2 - right.x1 == width and top.y2 - top.y1 == width and bottom.y2 - bottom.y1 == width
+
+def optimize(cmds):
+    # Join adjacent words that share a line, font and colour into one text
+    # run, and turn four-sided borders into single outlines
+    out = []
+    spaces = {}
+    i = 0
+    while i < len(cmds):
+        cmd = cmds[i]
+        if isinstance(cmd, DrawRect) and i + 3 < len(cmds) and \
+           all(isinstance(c, DrawRect) for c in cmds[i+1:i+4]) and is_frame(*cmds[i:i+4]):
+            out.append(DrawOutline(cmd.x1, cmd.y1, cmds[i+1].x2, cmd.y2, cmd.x2 - cmd.x1))
+            i += 4
+            continue
+        prev = out[-1] if out else None
+        if isinstance(cmd, DrawText) and isinstance(prev, DrawText) and \
+           cmd.w is not None and prev.w is not None and \
+           cmd.y == prev.y and cmd.font is prev.font and cmd.color == prev.color:
+            space = spaces.get(id(cmd.font))
+            if space is None:
+                space = spaces[id(cmd.font)] = cmd.font.measure(" ")
+            if cmd.x == prev.x + prev.w + space:
+                out[-1] = DrawText(prev.x, prev.y, prev.text + " " + cmd.text, prev.font, prev.color,
+                                   prev.y2 - prev.y1, cmd.x + cmd.w - prev.x)
+                i += 1
+                continue
+        out.append(cmd)
+        i += 1
+    return out
+
+TILE_HEIGHT = 256
+
+class DisplayList:
+    # Commands in paint order, bucketed into horizontal tiles by the y range they cover
+    def __init__(self, cmds):
+        self.cmds = cmds
+        self.tiles = []
+        for i, cmd in enumerate(cmds):
+            first = max(int(cmd.y1 // TILE_HEIGHT), 0)
+            last = max(int(cmd.y2 // TILE_HEIGHT), first)
+            if last >= len(self.tiles):
+                self.tiles.extend([] for _ in range(last + 1 - len(self.tiles)))
+            for tile in range(first, last + 1):
+                self.tiles[tile].append(i)
+
+    def __iter__(self):
+        return iter(self.cmds)
+
+    def __len__(self):
+        return len(self.cmds)
+
+    def visible_indices(self, top, bottom):
+        first = max(int(top // TILE_HEIGHT), 0)
+        last = min(int(bottom // TILE_HEIGHT), len(self.tiles) - 1)
+        if first == last:
+            found = self.tiles[first]
+        else:
+            # Tall commands sit in several tiles; keep each once, in paint order
+            found = sorted(set(i for tile in range(first, last + 1) for i in self.tiles[tile]))
+        cmds = self.cmds
+        return [i for i in found if cmds[i].y2 >= top and cmds[i].y1 <= bottom]
+
+    def visible(self, top, bottom):
+        return [self.cmds[i] for i in self.visible_indices(top, bottom)]
+
+class RetainedRenderer:
+    # Keeps canvas items alive across scrolls: existing items are moved, and
+    # only commands that scroll into view are created
+    def __init__(self, canvas, height, margin=20):
+        self.canvas = canvas
+        self.height = height
+        self.margin = margin
+        self.display_list = None
+        self.scrolly = 0
+        self.items = {} # display list index -> canvas item id
+
+    def render(self, display_list, scrolly):
+        if display_list is not self.display_list:
+            self.canvas.delete("all")
+            self.items = {}
+            self.display_list = display_list
+        elif scrolly != self.scrolly:
+            self.canvas.move("all", 0, self.scrolly - scrolly)
+        self.scrolly = scrolly
+
+        top = scrolly - self.margin
+        bottom = scrolly + self.height + self.margin
+        # Items more than a screen away are dropped so the canvas stays small
+        for i in [i for i in self.items
+                  if display_list.cmds[i].y2 < top - self.height or
+                     display_list.cmds[i].y1 > bottom + self.height]:
+            self.canvas.delete(self.items.pop(i))
+        for i in display_list.visible_indices(top, bottom):
+            if i not in self.items:
+                self.items[i] = display_list.cmds[i].draw(scrolly, self.canvas)
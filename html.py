@@ -1,39 +1,110 @@
+import re
+import sys
+import types
+
 class Tag:
+    __slots__ = ("tag",)
+
     def __init__(self, tag):
         self.tag = tag
 
 class Text:
+    __slots__ = ("text",)
+
     def __init__(self, text):
         self.text = text
 
+EMPTY_ATTRIBUTES = types.MappingProxyType({})
+EMPTY_STYLE = types.MappingProxyType({})
+INITIAL_STYLE = types.MappingProxyType({
+    "font-weight": "normal",
+    "font-style": "normal",
+    "color": "black",
+})
+
 class ElementNode:
+    __slots__ = ("handle", "tag", "children", "attributes", "parent", "style",
+                 "style_dirty", "child_dirty", "layout_dirty")
+
     def __init__(self, parent, tagname):
         self.handle=None
-        self.tag, *attrs = tagname.split(" ")
-        self.children = []
-        self.attributes = {}
+        # style_dirty: this element needs restyling; child_dirty: some descendant does
+        self.style_dirty = True
+        self.child_dirty = False
+        # layout_dirty: the layout of this subtree is stale (always set on ancestors too)
+        self.layout_dirty = True
+        tag, *attrs = tagname.split(" ")
+        self.tag = sys.intern(tag)
+        # Leaf elements share the empty tuple and attribute map until written
+        self.children = ()
+        self.attributes = EMPTY_ATTRIBUTES
         self.parent = parent
 
-        for attr in attrs:
-            out = attr.split("=", 1)
-            name = out[0]
-            val = out[1].strip("\"") if len(out) > 1 else ""
-            self.attributes[name.lower()] = val
-        self.style = self.compute_style()
-        self.style["font-weight"] = "normal"
-        self.style["font-style"] = "normal"
-        self.style["color"] = "black"
-
-    
+        if attrs:
+            self.attributes = {}
+            for attr in attrs:
+                out = attr.split("=", 1)
+                name = out[0]
+                val = out[1].strip("\"") if len(out) > 1 else ""
+                self.attributes[sys.intern(name.lower())] = val
+        # Only elements with inline style need a style map before styling
+        if "style" in self.attributes:
+            self.style = {**self.compute_style(), **INITIAL_STYLE}
+        else:
+            self.style = INITIAL_STYLE
+
     def compute_style(self):
+        style_value = self.attributes.get("style")
+        if not style_value: return EMPTY_STYLE
         style = {}
-        style_value = self.attributes.get("style", "")
         for line in style_value.split(";"):
             split = line.split(':')
             prop, val = split if len(split) == 2 else (split[0], None)
             style[prop.lower().strip()] = val.strip() if val is not None else None
         return style
 
+    def mark_child_dirty(self):
+        # Stop at the first ancestor that is already marked; its ancestors are too
+        node = self
+        while node is not None and not node.child_dirty:
+            node.child_dirty = True
+            node = node.parent
+
+    def mark_style_dirty(self):
+        self.style_dirty = True
+        if self.parent is not None:
+            self.parent.mark_child_dirty()
+        self.mark_layout_dirty()
+
+    def mark_layout_dirty(self):
+        node = self
+        while node is not None and not node.layout_dirty:
+            node.layout_dirty = True
+            node = node.parent
+
+    def set_attribute(self, name, value):
+        if self.attributes is EMPTY_ATTRIBUTES:
+            self.attributes = {}
+        self.attributes[sys.intern(name)] = value
+        self.mark_style_dirty()
+
+    def remove_attribute(self, name):
+        if name in self.attributes:
+            del self.attributes[name]
+            self.mark_style_dirty()
+
+    def append_child(self, child):
+        if not self.children:
+            self.children = []
+        self.children.append(child)
+        self.mark_child_dirty()
+        self.mark_layout_dirty()
+
+    def set_children(self, children):
+        self.children = list(children)
+        self.mark_child_dirty()
+        self.mark_layout_dirty()
+
     def __str__(self, level = 0):
         result = " "*level+"{}, {}, {{self.style}}".format(self.tag, self.attributes)
         for c in self.children:
@@ -41,34 +112,78 @@ class ElementNode:
         return result
 
 class TextNode:
+    __slots__ = ("text", "parent")
+
     def __init__(self, parent, text):
         self.text = text
         self.parent = parent
-        self.style = self.parent.style
+
+    @property
+    def style(self):
+        # Text always shares its element's computed style
+        return self.parent.style
 
     def __str__(self, level = 0):
         return " "*level + self.text
 
+DELIMITER = re.compile("([<>])")
+
+class Lexer:
+    def __init__(self):
+        # Text after the last delimiter, waiting for the next chunk
+        self.pending = []
+
+    def feed(self, chunk):
+        # Alternating text and delimiter pieces: [text, "<" or ">", text, ...]
+        pieces = DELIMITER.split(chunk)
+        if len(pieces) == 1:
+            self.pending.append(chunk)
+            return []
+        if self.pending:
+            self.pending.append(pieces[0])
+            pieces[0] = "".join(self.pending)
+            self.pending = []
+        out = []
+        append = out.append
+        for i in range(1, len(pieces), 2):
+            text = pieces[i - 1]
+            if pieces[i] == "<":
+                if text: append(Text(text))
+            else:
+                append(Tag(text))
+        if pieces[-1]:
+            self.pending.append(pieces[-1])
+        return out
+
+    def close(self):
+        # Like the old character loop, trailing text with no delimiter is dropped
+        self.pending = []
+        return []
+
+def tokenize(source):
+    # source is either a whole document or an iterable of text chunks
+    chunks = [source] if isinstance(source, str) else source
+    lexer = Lexer()
+    for chunk in chunks:
+        yield from lexer.feed(chunk)
+    yield from lexer.close()
+
 def lex(source):
-    out = []
-    text = ""
-    in_angle = False
-    for c in source:
-        if c == "<":
-            in_angle = True
-            if text: out.append(Text(text))
-            text = ""
-        elif c == ">":
-            in_angle = False
-            out.append(Tag(text))
-            text = ""
-        else:
-            text += c
-    return out
+    return list(tokenize(source))
 
-def parse(tokens):
-    current = None
-    for tok in tokens:
+class TreeBuilder:
+    def __init__(self, on_element=None):
+        self.root = None
+        self.current = None
+        # Called with each element as it joins the tree, e.g. to start fetching it
+        self.on_element = on_element
+
+    def feed(self, tokens):
+        for tok in tokens:
+            self.add(tok)
+
+    def add(self, tok):
+        current = self.current
         if isinstance(tok, Tag):
             if tok.tag.startswith("/"): # Close tag
                 tag = tok.tag[1:]
@@ -81,10 +196,21 @@ def parse(tokens):
                     current = node.parent
             else: # Open tag
                 new = ElementNode(current, tok.tag)
-                if current is not None: current.children.append(new)
+                if current is not None: current.append_child(new)
+                if self.root is None: self.root = new
+                if self.on_element is not None: self.on_element(new)
                 if new.tag not in ["br", "link", "meta", "input"]: # lab x
                     current = new
         else: # Text token
             new = TextNode(current, tok.text)
-            current.children.append(new)
-    return current
+            current.append_child(new)
+        self.current = current
+
+    def close(self):
+        # Tags left open are closed by the end of the document
+        return self.root
+
+def parse(tokens):
+    builder = TreeBuilder()
+    builder.feed(tokens)
+    return builder.close()
@@ -1,11 +1,11 @@
-import tkinter
-import tkinter.font
+import array
+import bisect
+from fonts import get_font, font_metrics, measure, measure_all
 from html import TextNode, ElementNode
 from graphics import DrawText, DrawRect
-from timing import Timer
 
-METRIC_CACHE = dict()
-GAP_CACHE = dict()
+# Height guessed for a box not laid out yet, when none of its siblings has been
+ESTIMATED_HEIGHT = 20
 
 def px(something):
     #ROBUST
@@ -24,15 +24,39 @@ def is_checkbox(node):
 def is_checked(node):
     return is_checkbox(node) and "checked" in node.attributes.keys()
 
+class Page:
+    def __init__(self):
+        self.x = 13
+        self.y = 13
+        self.w = 774
+        self.children = []
+
+    def content_left(self):
+        return self.x
+    def content_top(self):
+        return self.y
+    def content_width(self):
+        return self.w
+
 class BlockLayout:
     def __init__(self, parent, node):
         self.parent = parent
         self.mt = px(node.style.get("margin-top", "0px"))
         self.mb = px(node.style.get("margin-bottom", "0px"))
         self.x = parent.content_left()
+        self.y = 0
+        self.w = None
         self.h = None
+        self.children = []
         self.node = node
-        self.timer = Timer()
+        # Set when layout1 recomputed this box, so layout2 must place it afresh
+        self.moved = True
+        # Draw commands for inline content, kept until the box is recomputed
+        self.commands = None
+        # Set when some content below was not laid out and h includes a guess for it
+        self.partial = False
+        # Boxes of children that a partial pass did not reach, kept for the next pass
+        self.deferred = {}
         
     # def layout1(self):
     #     y = 0
@@ -55,9 +79,21 @@ class BlockLayout:
     #     y += self.pb + self.bb
     #     self.h = y - self.y
 
-    def layout1(self):
-        self.children = []
+    def layout1(self, until=None):
+        # With until set, children starting more than until below this box's
+        # top are not laid out the first time; their height is estimated, and
+        # a later call with a larger until carries on
         self.parent.children.append(self)
+        w = self.parent.content_width() - \
+            px(self.node.style.get("margin-left", "0px")) - px(self.node.style.get("margin-right", "0px"))
+        if not self.node.layout_dirty and self.h is not None and w == self.w:
+            # Nothing under this node changed, so its boxes are still good
+            return
+        old = self.deferred
+        old.update((child.node, child) for child in self.children if isinstance(child, BlockLayout))
+        self.children = []
+        self.moved = True
+        self.commands = None
         self.mt = px(self.node.style.get("margin-top", "0px"))
         self.mr = px(self.node.style.get("margin-right", "0px"))
         self.mb = px(self.node.style.get("margin-bottom", "0px"))
@@ -76,46 +112,89 @@ class BlockLayout:
         
         y = 0
         self.y = 0
-        self.x += self.ml
+        self.x = self.parent.content_left() + self.ml
         self.w -= self.ml + self.mr
 
+        self.partial = False
+
         y = self.y + self.bt + self.pt
         if any(is_inline(child) for child in self.node.children):
             layout = InlineLayout(self, self.node)
             layout.layout1()
             y += layout.height()
         else:
-            for child in self.node.children:
-                if isinstance(child, TextNode) and child.text.isspace(): continue
-                layout = BlockLayout(self, child)
-                y += layout.mt
-                layout.layout1()
-                y += layout.height() + layout.mb
+            children = [child for child in self.node.children
+                        if not (isinstance(child, TextNode) and child.text.isspace())]
+            for i, child in enumerate(children):
+                # Boxes from earlier passes are kept even past until, so an edit
+                # only redoes what changed; only new boxes wait for a later pass
+                if until is not None and y >= until and child not in old:
+                    # Guess the rest are as tall as the ones laid out so far
+                    done = len(self.children)
+                    guess = (y - self.bt - self.pt) / done if done else ESTIMATED_HEIGHT
+                    y += guess * (len(children) - i)
+                    self.partial = True
+                    break
+                layout = old.get(child) or BlockLayout(self, child)
+                layout.layout1(None if until is None else until - y - layout.mt)
+                if layout.partial: self.partial = True
+                y += layout.mt + layout.height() + layout.mb
         y += self.pb + self.bb
         self.h = y - self.y
+        # Partly estimated boxes stay dirty so the next pass comes back to them
+        if self.partial:
+            self.deferred = old
+        else:
+            self.deferred = {}
+            self.node.layout_dirty = False
         
     def layout2(self,y):
-        self.x = self.parent.content_left()
+        x = self.parent.content_left() + self.ml
+        y += self.mt
+        if not self.moved and x == self.x:
+            # Same size as last time; at most the whole subtree slid up or down
+            if y != self.y: self.shift(y - self.y)
+            return
+        self.moved = False
+        # Cached commands were painted at the old x
+        if x != self.x: self.commands = None
+        self.x = x
         self.y = y
-        self.x += self.ml
-        self.y += self.mt
-        y = self.y
         for child in self.children:
             child.layout2(y)
             y += child.h + (child.mt + child.mb if isinstance(child, BlockLayout) else 0)
 
+    def shift(self, dy):
+        self.y += dy
+        for child in self.children:
+            child.shift(dy)
+        if self.commands is not None:
+            for cmd in self.commands:
+                cmd.shift(dy)
+
     def height(self):
         return self.h
 
     def display_list(self):
         dl = []
+        self.paint(dl)
+        return dl
+
+    def paint(self, dl):
+        # Appends to dl; boxes holding inline content replay their last commands
+        # unless layout1 recomputed them
+        if self.commands is not None:
+            dl.extend(self.commands)
+            return
+        start = len(dl)
         for child in self.children:
-            dl.extend(child.display_list())
+            child.paint(dl)
         if self.bl > 0: dl.append(DrawRect(self.x, self.y, self.x + self.bl, self.y + self.h))
         if self.br > 0: dl.append(DrawRect(self.x + self.w - self.br, self.y, self.x + self.w, self.y + self.h))
         if self.bt > 0: dl.append(DrawRect(self.x, self.y, self.x + self.w, self.y + self.bt))
         if self.bb > 0: dl.append(DrawRect(self.x, self.y + self.h - self.bb, self.x + self.w, self.y + self.h))
-        return dl
+        if self.children and isinstance(self.children[0], InlineLayout):
+            self.commands = dl[start:]
 
     def content_left(self):
         return self.x + self.bl + self.pl
@@ -149,17 +228,20 @@ class LineLayout:
             x += child.w + child.space
         self.w = x - self.x
 
+    def shift(self, dy):
+        self.y += dy
+        for child in self.children:
+            child.shift(dy)
+
     def height(self):
         return self.h
 
-    def display_list(self):
-        dl = []
+    def paint(self, dl):
         for child in self.children:
-            dl.extend(child.display_list())
-        return dl
+            child.paint(dl)
         
 class TextLayout:
-    def __init__(self, node, text):
+    def __init__(self, node, text, w=None):
         self.children = []
         self.node = node
         self.text = text
@@ -167,18 +249,12 @@ class TextLayout:
         self.bold = node.style["font-weight"] == "bold"
         self.italic = node.style["font-style"] == "italic"
         self.color = node.style["color"]
-        self.font = tkinter.font.Font(
-            family="Times", size=16,
-            weight="bold" if self.bold else "normal",
-            slant="italic" if self.italic else "roman"
-        )
-        key = (self.bold, self.italic, text)
-        if key in METRIC_CACHE.keys():
-            self.h, self.w = METRIC_CACHE[key]
-        else:
-            self.h = self.font.metrics('linespace')
-            self.w = self.font.measure(text)
-            METRIC_CACHE[key] = (self.h, self.w)
+        weight = "bold" if self.bold else "normal"
+        slant = "italic" if self.italic else "roman"
+        self.font = get_font("Times", 16, weight, slant)
+        self.h = font_metrics("Times", 16, weight, slant)[0]
+        # Runs of several words pass in the width their words add up to
+        self.w = measure(text, "Times", 16, weight, slant) if w is None else w
 
 
     def height(self):
@@ -186,11 +262,9 @@ class TextLayout:
         return self.h
     
     def add_space(self):
-        if (self.bold, self.italic) in GAP_CACHE.keys():
-            gap = GAP_CACHE[(self.bold, self.italic)]
-        else:
-            gap = self.font.measure(" ")
-            GAP_CACHE[(self.bold, self.italic)] = gap
+        gap = font_metrics("Times", 16,
+                           "bold" if self.bold else "normal",
+                           "italic" if self.italic else "roman")[1]
         self.space = gap
         self.parent.w += gap
             
@@ -203,20 +277,19 @@ class TextLayout:
         bold = node.style["font-weight"] == "bold"
         italic = node.style["font-style"] == "italic"
         self.color = node.style["color"]
-        self.font = tkinter.font.Font(
-            family="Times", size=16,
-            weight="bold" if bold else "normal",
-            slant="italic" if italic else "roman"
-        )
+        self.font = get_font("Times", 16, "bold" if bold else "normal", "italic" if italic else "roman")
         self.w = self.font.measure(text)
         self.h = self.font.metrics('linespace')
 
     def layout2(self, x, y):
         self.x = x
         self.y = y
+
+    def shift(self, dy):
+        self.y += dy
         
-    def display_list(self):
-        return [DrawText(self.x, self.y, self.text, self.font, self.color, self.h)]
+    def paint(self, dl):
+        dl.append(DrawText(self.x, self.y, self.text, self.font, self.color, self.h, self.w))
     
 class InlineLayout:
     def __init__(self, block, node):
@@ -230,16 +303,17 @@ class InlineLayout:
         self.node = node
 
     def font(self):
-        return tkinter.font.Font(
-            family="Times", size=16,
-            weight=self.parent.node.style["font-weight"],
-            slant="roman" if self.parent.node.style["font-style"] == "normal" else "italic"
+        return get_font(
+            "Times", 16,
+            self.parent.node.style["font-weight"],
+            "roman" if self.parent.node.style["font-style"] == "normal" else "italic"
         )
 
     def height(self):
         return self.h
 
     def recurse(self, node):
+        if isinstance(node, ElementNode): node.layout_dirty = False
         # Input box lab x
         if isinstance(node, ElementNode) and node.tag in ("input", "textarea", "button"):
             self.input(node)
@@ -251,6 +325,7 @@ class InlineLayout:
     # lab x
     def input(self, node):
         tl = InputLayout(node, node.tag == "textarea")
+        tl.layout1()
         line = self.children[-1]
         if line.w + tl.w > self.w:
             line = LineLayout(self)
@@ -260,15 +335,36 @@ class InlineLayout:
         words = node.text.split()
         if node.text[0].isspace() and len(self.children[-1].children) > 0:
             self.children[-1].children[-1].add_space()
-
-        for i, word in enumerate(words):
-            tl  = TextLayout(node, word)
-            line = self.children[-1]
-            if line.w + tl.w > self.w:
+        if not words: return
+
+        weight = "bold" if node.style["font-weight"] == "bold" else "normal"
+        slant = "italic" if node.style["font-style"] == "italic" else "roman"
+        space = font_metrics("Times", 16, weight, slant)[1]
+        widths = measure_all(words, "Times", 16, weight, slant)
+        # ends[i] is how far word i reaches from the start of the text,
+        # counting a space after every word before it
+        ends = array.array("l", widths)
+        offset = 0
+        for i, w in enumerate(widths):
+            ends[i] += offset
+            offset += w + space
+
+        # Greedy breaking: a word stays on the line while line.w plus the
+        # words and spaces up to its end fit in self.w
+        line = self.children[-1]
+        i = 0
+        while i < len(words):
+            start = ends[i] - widths[i]
+            j = bisect.bisect_right(ends, self.w - line.w + start, i)
+            if j == i:
+                # Word i goes first on a new line, whether or not it fits there
                 line = LineLayout(self)
+                j = bisect.bisect_right(ends, self.w + start, i + 1)
+            tl = TextLayout(node, " ".join(words[i:j]), ends[j - 1] - start)
             tl.attach(line)
-            if i != len(words) - 1 or node.text[-1].isspace():
+            if j != len(words) or node.text[-1].isspace():
                 tl.add_space()
+            i = j
 
 
     def layout1(self):
@@ -290,6 +386,11 @@ class InlineLayout:
             child.layout2(y)
             y += child.h
 
+    def shift(self, dy):
+        self.y += dy
+        for child in self.children:
+            child.shift(dy)
+
     # def layout(self):
     #     self.x = self.parent.content_left()
     #     self.y = self.parent.content_top()
@@ -301,12 +402,10 @@ class InlineLayout:
     #         y += child.h
     #     self.h = y - self.y
 
-    def display_list(self):
-        dl = []
+    def paint(self, dl):
         for child in self.children:
             assert(isinstance(child, LineLayout))
-            dl.extend(child.display_list())
-        return dl
+            child.paint(dl)
 
     def content_left(self):
         return self.x + self.bl + self.pl
@@ -322,9 +421,12 @@ class InputLayout:
         self.node = node
         self.space = 0
         self.multiline = multiline
+        self.x = 0
+        self.y = 0
         # EX 1
 
     def layout1(self):
+        self.children = []
         self.child_layout = []
         if is_checkbox(self.node):
             self.w = 20
@@ -340,7 +442,12 @@ class InputLayout:
         self.x = x
         self.y = y
         for child in self.child_layout:
-            child.layout2()
+            child.layout2(y)
+
+    def shift(self, dy):
+        self.y += dy
+        for child in self.child_layout:
+            child.shift(dy)
 
     def attach(self, parent):
 	    self.parent = parent
@@ -353,27 +460,24 @@ class InputLayout:
 	        self.space = gap
 	        self.parent.w += gap
 
-    def display_list(self):
+    def paint(self, dl):
         border = DrawRect(self.x, self.y, self.x + self.w, self.y + self.h)
         if self.children:
-            dl = []
             for child in self.children:
-                dl.extend(child.display_list())
+                child.paint(dl)
             dl.append(border)
-            return dl
         elif (self.node.tag == "button" or 
               (self.node.tag == "input" and not is_checkbox(self.node))): # EX 1
-            font = tkinter.font.Font(family="Times", size=16)
-            text = DrawText(self.x + 1, self.y + 1, self.node.attributes.get("value", ""), font, 'black')
-            return [border, text]
+            font = get_font("Times", 16)
+            text = DrawText(self.x + 1, self.y + 1, self.node.attributes.get("value", ""), font, 'black', self.h - 2)
+            dl.extend((border, text))
         else: # EX 1
             assert(is_checkbox(self.node))
+            dl.append(border)
             if is_checked(self.node):
-                font = tkinter.font.Font(family="Times", size=16)
-                tick = DrawText(self.x + 1, self.y + 1, "X", font, 'black')
-                return [border, tick]
-            else:
-                return [border]
+                font = get_font("Times", 16)
+                tick = DrawText(self.x + 1, self.y + 1, "X", font, 'black', self.h - 2)
+                dl.append(tick)
 
     def input(self, node):
         tl = InputLayout(node, node.tag == "textarea")
@@ -393,3 +497,79 @@ class InputLayout:
 
     def content_width(self):
         return self.w - 2
+
+class IntervalTree:
+    # Centered interval tree over half-open [start, end) ranges
+    def __init__(self, intervals):
+        self.center = None
+        # Empty ranges hold no points, and would never settle at a center
+        intervals = [iv for iv in intervals if iv[0] < iv[1]]
+        if not intervals: return
+        # The median start lies in its own range, so every level keeps at least one
+        starts = sorted(iv[0] for iv in intervals)
+        self.center = center = starts[len(starts) // 2]
+        here = [iv for iv in intervals if iv[0] <= center < iv[1]]
+        self.by_start = sorted(here, key=lambda iv: iv[0])
+        self.by_end = sorted(here, key=lambda iv: iv[1], reverse=True)
+        self.left = IntervalTree([iv for iv in intervals if iv[1] <= center])
+        self.right = IntervalTree([iv for iv in intervals if iv[0] > center])
+
+    def stab(self, point):
+        tree = self
+        while tree.center is not None:
+            if point < tree.center:
+                for start, end, item in tree.by_start:
+                    if start > point: break
+                    yield item
+                tree = tree.left
+            else:
+                for start, end, item in tree.by_end:
+                    if end <= point: break
+                    yield item
+                tree = tree.right
+
+class HitIndex:
+    # Answers "which node is at (x, y)" the way a children-first walk of the
+    # layout tree would: boxes are ranked in that walk's order and the lowest
+    # ranked box containing the point wins. Blocks are found by their y range;
+    # words and inputs are found through their line, then by x.
+    def __init__(self, layout):
+        self.rank = 0
+        intervals = []
+        self.add(layout, intervals)
+        self.tree = IntervalTree(intervals)
+
+    def add(self, layout, intervals, leaves=None):
+        if isinstance(layout, LineLayout):
+            line = []
+            for child in layout.children:
+                self.add(child, intervals, line)
+            # Words and inputs sit left to right on a line
+            if line:
+                y1 = min(leaf[2] for leaf in line)
+                y2 = max(leaf[3] for leaf in line)
+                intervals.append((y1, y2, (True, [leaf[0] for leaf in line], line)))
+            return
+        # Inputs lay out their contents too, and those come first in the walk
+        for child in getattr(layout, "children", ()):
+            self.add(child, intervals)
+        if hasattr(layout, "node"):
+            x1, y1 = layout.x, layout.y
+            box = (x1, x1 + layout.w, y1, y1 + layout.height(), self.rank, layout.node)
+            self.rank += 1
+            if leaves is not None:
+                leaves.append(box)
+            else:
+                intervals.append((y1, box[3], (False, None, box)))
+
+    def find(self, x, y):
+        best = None
+        for is_line, starts, item in self.tree.stab(y):
+            if is_line:
+                i = bisect.bisect_right(starts, x) - 1
+                if i < 0: continue
+                item = item[i]
+            x1, x2, y1, y2, rank, node = item
+            if x1 <= x < x2 and y1 <= y < y2 and (best is None or rank < best[0]):
+                best = (rank, node)
+        return best[1] if best else None
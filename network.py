@@ -1,4 +1,11 @@
+import codecs
 import socket
+import threading
+import time
+from cache import HTTPCache
+
+MAX_CONNECTIONS_PER_HOST = 6
+IDLE_TIMEOUT = 30
 
 def parse_url(url):
     if url.startswith("http://"):
@@ -8,26 +15,257 @@ def parse_url(url):
     path, fragment = ("/" + pathfragment).rsplit("#", 1) if "#" in pathfragment else ("/" + pathfragment, None)
     return host, int(port), path, fragment
 
-def request(method, host, port, path, body = None):
-    s = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP)
-    s.connect((host, port))
-    s.send("{} {} HTTP/1.0\r\nHost: {}\r\n".format(method, path, host).encode("utf8"))
-    if body:
-        body = body.encode("utf8")
-        s.send("Content-Length: {}\r\n\r\n".format(len(body)).encode("utf8"))
-        s.send(body)
-    else:
-        s.send("\r\n".encode('utf8'))
-    response = s.makefile("rb").read().decode("utf8")
-    s.close()
-    
-    head, body = response.split("\r\n\r\n", 1)
-    lines = head.split("\r\n")
-    version, status, explanation = lines[0].split(" ", 2)
-    assert status == "200", "Server error {}: {} ({}:{}/{})".format(status, explanation, host, port, path)
+class Connection:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP)
+        self.sock.connect((host, port))
+        self.file = self.sock.makefile("rb")
+        self.last_used = time.monotonic()
+        # Has this socket already carried a response?
+        self.reused = False
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+class ConnectionPool:
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST, idle_timeout=IDLE_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.idle = {}   # (host, port) -> [Connection], most recently used last
+        self.open = {}   # (host, port) -> number of live connections
+        self.cond = threading.Condition()
+
+    def acquire(self, host, port):
+        key = (host, port)
+        with self.cond:
+            while True:
+                self.evict_idle()
+                idle = self.idle.get(key)
+                if idle:
+                    conn = idle.pop()
+                    if not idle: del self.idle[key]
+                    return conn
+                if self.open.get(key, 0) < self.max_per_host:
+                    self.open[key] = self.open.get(key, 0) + 1
+                    break
+                self.cond.wait()
+        try:
+            return Connection(host, port)
+        except OSError:
+            self.discard_slot(key)
+            raise
+
+    def release(self, conn, reusable):
+        key = (conn.host, conn.port)
+        if not reusable:
+            conn.close()
+            self.discard_slot(key)
+            return
+        conn.last_used = time.monotonic()
+        conn.reused = True
+        with self.cond:
+            self.idle.setdefault(key, []).append(conn)
+            self.cond.notify_all()
+
+    def discard_slot(self, key):
+        with self.cond:
+            self.open[key] -= 1
+            if not self.open[key]: del self.open[key]
+            self.cond.notify_all()
+
+    def evict_idle(self):
+        # Caller holds self.cond
+        now = time.monotonic()
+        for key, conns in list(self.idle.items()):
+            keep = []
+            for conn in conns:
+                if now - conn.last_used > self.idle_timeout:
+                    conn.close()
+                    self.open[key] -= 1
+                else:
+                    keep.append(conn)
+            if keep:
+                self.idle[key] = keep
+            else:
+                del self.idle[key]
+            if not self.open.get(key): self.open.pop(key, None)
+
+    def close_all(self):
+        with self.cond:
+            for key, conns in self.idle.items():
+                for conn in conns:
+                    conn.close()
+                    self.open[key] -= 1
+                if not self.open.get(key): self.open.pop(key, None)
+            self.idle = {}
+            self.cond.notify_all()
+
+POOL = ConnectionPool()
+
+CHUNK_SIZE = 16 * 1024
+
+def iter_chunked(f):
+    while True:
+        size = int(f.readline().split(b";", 1)[0].strip(), 16)
+        if size == 0: break
+        while size > 0:
+            data = f.read(min(size, CHUNK_SIZE))
+            if not data:
+                raise ConnectionResetError("Connection closed mid-chunk")
+            size -= len(data)
+            yield data
+        f.readline()
+    # Trailers, up to the blank line
+    while f.readline() not in (b"\r\n", b"\n", b""):
+        pass
+
+def iter_length(f, length):
+    while length > 0:
+        data = f.read(min(length, CHUNK_SIZE))
+        if not data:
+            raise ConnectionResetError("Connection closed mid-body")
+        length -= len(data)
+        yield data
+
+def iter_eof(f):
+    while True:
+        data = f.read1(CHUNK_SIZE)
+        if not data: break
+        yield data
+
+def read_head(f):
+    statusline = f.readline().decode("utf8")
+    if not statusline:
+        raise ConnectionResetError("Connection closed before response")
+    version, status, explanation = statusline.rstrip("\r\n").split(" ", 2)
     headers = {}
-    for line in lines[1:]:
+    while True:
+        line = f.readline().decode("utf8")
+        if line in ("\r\n", "\n", ""): break
         header, value = line.split(":", 1)
         headers[header.lower()] = value.strip()
-    return headers, body
+    return version, status, explanation, headers
+
+def body_framing(f, method, version, status, headers):
+    connection = headers.get("connection", "").lower()
+    keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+    if method == "HEAD" or status in ("204", "304") or status.startswith("1"):
+        return iter(()), keep_alive
+    elif "chunked" in headers.get("transfer-encoding", "").lower():
+        return iter_chunked(f), keep_alive
+    elif "content-length" in headers:
+        return iter_length(f, int(headers["content-length"])), keep_alive
+    else:
+        # No framing: the body runs until the server hangs up
+        return iter_eof(f), False
+
+class BodyStream:
+    def __init__(self, pool, conn, raw, keep_alive):
+        self.pool = pool
+        self.conn = conn
+        self.raw = raw
+        self.keep_alive = keep_alive
+        self.decoder = codecs.getincrementaldecoder("utf8")()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.conn is None: raise StopIteration
+        try:
+            for data in self.raw:
+                text = self.decoder.decode(data)
+                if text: return text
+        except:
+            self.close()
+            raise
+        text = self.decoder.decode(b"", final=True)
+        self.release(self.keep_alive)
+        if text: return text
+        raise StopIteration
+
+    def release(self, reusable):
+        if self.conn is not None:
+            self.pool.release(self.conn, reusable)
+            self.conn = None
+
+    def close(self):
+        # An abandoned or failed body leaves the socket mid-response
+        self.release(False)
+
+    def __del__(self):
+        self.close()
+
+CACHE = HTTPCache()
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE")
+
+def open_response(method, host, port, path, body, pool, extra_headers):
+    if body:
+        body = body.encode("utf8")
+    while True:
+        conn = pool.acquire(host, port)
+        reused = conn.reused
+        try:
+            msg = "{} {} HTTP/1.1\r\nHost: {}\r\nConnection: keep-alive\r\n".format(method, path, host)
+            for header, value in extra_headers.items():
+                msg += "{}: {}\r\n".format(header, value)
+            if body:
+                msg += "Content-Length: {}\r\n".format(len(body))
+            conn.sock.sendall(msg.encode("utf8") + b"\r\n" + (body or b""))
+            version, status, explanation, headers = read_head(conn.file)
+        except OSError:
+            pool.release(conn, False)
+            # The server may have dropped an idle keep-alive socket; retry on a fresh
+            # one, but only when sending the request twice is harmless
+            if reused and method in IDEMPOTENT_METHODS: continue
+            raise
+        except:
+            pool.release(conn, False)
+            raise
+        return conn, version, status, explanation, headers
+
+def cache_into(cache, url, headers, chunks):
+    parts = []
+    for text in chunks:
+        parts.append(text)
+        yield text
+    # Only a complete body is stored
+    cache.store(url, headers, "".join(parts))
+
+def request_stream(method, host, port, path, body = None, pool = None, cache = None):
+    pool = pool or POOL
+    cache = CACHE if cache is None else cache
+    entry = None
+    extra_headers = {}
+    if method == "GET" and cache:
+        url = cache.key(host, port, path)
+        entry = cache.lookup(url)
+        if entry is not None:
+            if entry.is_fresh(time.time()):
+                return entry.headers, iter([entry.body])
+            extra_headers = entry.validators()
+    elif cache:
+        # Unsafe methods invalidate what we hold for that URL
+        cache.remove(cache.key(host, port, path))
+
+    conn, version, status, explanation, headers = \
+        open_response(method, host, port, path, body, pool, extra_headers)
+    raw, keep_alive = body_framing(conn.file, method, version, status, headers)
+    if status == "304" and entry is not None:
+        pool.release(conn, keep_alive)
+        cache.freshen(entry, headers)
+        return entry.headers, iter([entry.body])
+    if status != "200":
+        pool.release(conn, False)
+    assert status == "200", "Server error {}: {} ({}:{}/{})".format(status, explanation, host, port, path)
+    chunks = BodyStream(pool, conn, raw, keep_alive)
+    if method == "GET" and cache:
+        return headers, cache_into(cache, url, headers, chunks)
+    return headers, chunks
 
+def request(method, host, port, path, body = None, pool = None, cache = None):
+    headers, chunks = request_stream(method, host, port, path, body, pool, cache)
+    return headers, "".join(chunks)
@@ -1,4 +1,10 @@
-from html import ElementNode
+import collections.abc
+import hashlib
+import os
+import pickle
+import re
+import weakref
+from html import ElementNode, INITIAL_STYLE
 
 class TagSelector:
     def __init__(self, tag):
@@ -10,6 +16,9 @@ class TagSelector:
     def score(self):
         return 1
 
+    def bucket(self):
+        return "tag", self.tag
+
     def __str__(self):
         return "Tag: " + self.tag
 
@@ -18,11 +27,14 @@ class ClassSelector:
         self.cls = cls
 
     def matches(self, node):
-        return self.cls == node.attributes.get("class", "").split()
+        return self.cls in node.attributes.get("class", "").split()
     
     def score(self):
         return 16
 
+    def bucket(self):
+        return "class", self.cls
+
     def __str__(self):
         return "class: " + self.cls
 
@@ -31,11 +43,14 @@ class IdSelector:
         self.id = id
 
     def matches(self, node):
-        return self.id == node.id
+        return self.id == node.attributes.get("id")
 
     def score(self):
         return 256
 
+    def bucket(self):
+        return "id", self.id
+
     def __str__(self):
         return "id: " + self.id
 
@@ -45,42 +60,6 @@ def css_value(s, i):
         j += 1
     return s[i:j], j
 
-def css_whitespace(s, i):
-    while i < len(s) and s[i] in " \t\n\f\r\v":
-        i += 1
-    return None, i
-
-def css_pair(s, i):
-    prop, i = css_value(s, i)
-    _, i = css_whitespace(s, i)
-    assert s[i] == ":"
-    i += 1
-    _, i = css_whitespace(s, i)
-    val, i = css_value(s, i)
-
-    return (prop, val), i
-
-def css_body(s, i):
-    pairs = dict()
-    assert s[i] == "{"
-    _, i = css_whitespace(s, i+1)
-    while True:
-        if s[i] == "}": break
-
-        try:
-            (prop, val), i = css_pair(s, i)
-            pairs[prop] = val
-            _, i = css_whitespace(s, i)
-            assert s[i] == ";"
-            _, i = css_whitespace(s, i+1)
-        except AssertionError:
-            while s[i] not in [";", "}"]:
-                i += 1
-            if s[i] == ";":
-                _, i = css_whitespace(s,i + 1)
-    assert s[i] == "}"
-    return pairs, i+1
-
 def css_selector(s, i):
     if s[i] == "#":
         name, i = css_value(s, i+1)
@@ -92,44 +71,287 @@ def css_selector(s, i):
         name, i = css_value(s, i)
         return TagSelector(name), i
 
+def css_name_ok(name):
+    return name != "" and name.replace("-", "").replace("_", "").isalnum()
+
+def css_simple_selector(text):
+    # Only single tag, .class and #id selectors are supported
+    text = text.strip()
+    if text[:1] == "#":
+        return IdSelector(text[1:]) if css_name_ok(text[1:]) else None
+    elif text[:1] == ".":
+        return ClassSelector(text[1:]) if css_name_ok(text[1:]) else None
+    else:
+        return TagSelector(text) if css_name_ok(text) else None
+
+CSS_COMMENT_OR_STRING = re.compile(r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|/\*.*?(?:\*/|\Z)', re.S)
+CSS_STRING = re.compile(r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'', re.S)
+CSS_TOP = re.compile(r'[{};"\']')
+CSS_BLOCK = re.compile(r'[{}"\']')
+CSS_NESTED = re.compile(r'[;,(){}\[\]"\']')
+CSS_OPENER = re.compile(r'[(\[{"\']')
+
+def css_strip_comments(s):
+    # A comment separates tokens like whitespace does; "/*" inside a string is not one
+    return CSS_COMMENT_OR_STRING.sub(lambda m: m.group() if m.group()[0] in "\"'" else " ", s)
+
+def css_string_end(s, i):
+    m = CSS_STRING.match(s, i)
+    if m: return m.end()
+    # An unterminated string stops at the end of its line
+    end = s.find("\n", i)
+    return end if end >= 0 else len(s)
+
+def css_block_end(s, i):
+    # Index of the "}" closing a block whose body starts at i
+    end = s.find("}", i)
+    if end >= 0 and "{" not in s[i:end] and "'" not in s[i:end] and '"' not in s[i:end]:
+        return end
+    depth = 1
+    while True:
+        m = CSS_BLOCK.search(s, i)
+        if m is None: return len(s)
+        c = m.group()
+        if c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0: return m.start()
+        else:
+            i = css_string_end(s, m.start())
+            continue
+        i = m.end()
+
+def css_split(s, i, end, sep):
+    # Split s[i:end] at sep, except inside strings and brackets
+    if not CSS_OPENER.search(s, i, end):
+        return s[i:end].split(sep)
+    parts = []
+    depth = 0
+    start = i
+    while True:
+        m = CSS_NESTED.search(s, i, end)
+        if m is None: break
+        c = m.group()
+        if c in "\"'":
+            i = css_string_end(s, m.start())
+            continue
+        if c in "([{":
+            depth += 1
+        elif c in ")]}":
+            depth = max(depth - 1, 0)
+        elif c == sep and depth == 0:
+            parts.append(s[start:m.start()])
+            start = m.end()
+        i = m.end()
+    parts.append(s[start:end])
+    return parts
+
+class Declarations(dict):
+    # Property -> value for one rule body, plus which properties were !important
+    def __init__(self):
+        super().__init__()
+        self.important = set()
+
+def css_declarations(s, i, end):
+    body = Declarations()
+    for decl in css_split(s, i, end, ";"):
+        prop, colon, val = decl.partition(":")
+        prop = prop.strip().lower()
+        val = val.strip()
+        if not colon or not css_name_ok(prop): continue
+        important = False
+        bang = val.rfind("!")
+        if bang >= 0 and val[bang+1:].strip().lower() == "important":
+            val = val[:bang].rstrip()
+            important = True
+        if not val: continue
+        if important:
+            body.important.add(prop)
+        elif prop in body.important:
+            continue
+        body[prop] = val
+    return body
+
 def parse_css(s):
-    i = 0
+    s = css_strip_comments(s)
     styles = []
-    _, i = css_whitespace(s,i)
-    while i < len(s):
-        # Eat whitespace
-       
-        selector, i = css_selector(s,i)
-        _, i = css_whitespace(s,i)
-        try: 
-            body, i = css_body(s,i)
-            styles.append((selector,body))
-        except AssertionError:
-            _, i = css_whitespace(s,i)
-            while s[i] != "}":
-                i += 1
-            i += 1
-        _, i = css_whitespace(s,i)
-    return styles
+    start = i = 0
+    while True:
+        m = CSS_TOP.search(s, i)
+        if m is None: break
+        c = m.group()
+        if c in "\"'":
+            i = css_string_end(s, m.start())
+            continue
+        if c == "{":
+            end = css_block_end(s, m.end())
+            prelude = s[start:m.start()].strip()
+            if not prelude.startswith("@"):
+                # At-rule blocks (@media, @font-face, ...) are skipped whole
+                body = css_declarations(s, m.end(), end)
+                # "h1, h2 { ... }" gives one rule per selector, sharing the body
+                for text in css_split(s, start, m.start(), ","):
+                    selector = css_simple_selector(text)
+                    if selector is not None:
+                        styles.append((selector, body))
+            i = end + 1
+        else:
+            # A statement at-rule like @import, or a stray "}": nothing to keep
+            i = m.end()
+        start = i
+    return RuleIndex(styles)
+
+class RuleIndex:
+    # Rules in cascade order, bucketed by the tag, class or id they need
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=lambda x: x[0].score())
+        self.buckets = {"tag": {}, "class": {}, "id": {}}
+        for i, (selector, pairs) in enumerate(self.rules):
+            kind, key = selector.bucket()
+            self.buckets[kind].setdefault(key, []).append(i)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __getitem__(self, i):
+        return self.rules[i]
+
+    def candidates(self, node):
+        out = list(self.buckets["tag"].get(node.tag, ()))
+        if node.attributes:
+            if self.buckets["id"] and "id" in node.attributes:
+                out.extend(self.buckets["id"].get(node.attributes["id"], ()))
+            if self.buckets["class"] and "class" in node.attributes:
+                for cls in set(node.attributes["class"].split()):
+                    out.extend(self.buckets["class"].get(cls, ()))
+            out.sort()
+        return out
+
+    def matching(self, node):
+        return tuple(i for i in self.candidates(node) if self.rules[i][0].matches(node))
+
+STYLESHEET_CACHE = {}
+STYLESHEET_FORMAT = 3 # bump when RuleIndex or the selector classes change shape
+
+def load_stylesheet(source, directory=None):
+    # Parsed rule sets are shared by every page whose stylesheet has the same text
+    key = hashlib.sha1(source.encode("utf8")).hexdigest()
+    rules = STYLESHEET_CACHE.get(key)
+    if rules is not None: return rules
+    path = None
+    if directory is not None:
+        path = os.path.join(directory, "{}-{}.pickle".format(key, STYLESHEET_FORMAT))
+        try:
+            with open(path, "rb") as f:
+                rules = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            rules = None
+    if rules is None:
+        rules = parse_css(source)
+        if path is not None:
+            os.makedirs(directory, exist_ok=True)
+            with open(path, "wb") as f:
+                pickle.dump(rules, f)
+    STYLESHEET_CACHE[key] = rules
+    return rules
+
+class ComputedStyle(collections.abc.Mapping):
+    # Immutable and hash-consed through intern_style, so equal styles are
+    # the same object and compare by identity
+    __slots__ = ("props", "hash", "__weakref__")
+
+    def __init__(self, props):
+        self.props = props
+        self.hash = hash(frozenset(props.items()))
+
+    def __getitem__(self, key):
+        return self.props[key]
+
+    def get(self, key, default=None):
+        return self.props.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.props
+
+    def __iter__(self):
+        return iter(self.props)
+
+    def __len__(self):
+        return len(self.props)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return self is other
+
+    def __repr__(self):
+        return "ComputedStyle({!r})".format(self.props)
+
+STYLE_TABLE = weakref.WeakValueDictionary()
+
+def intern_style(props):
+    key = frozenset(props.items())
+    computed = STYLE_TABLE.get(key)
+    if computed is None:
+        computed = ComputedStyle(props)
+        STYLE_TABLE[key] = computed
+    return computed
 
 INHERITED_PROPERTIES = [ ("font-style", "normal"),
                          ("font-weight", "normal"),
                          ("color", "black") ]
-def style(node, rules):
+def style_node(node, rules, cache):
+    matched = rules.matching(node)
+    parent_style = node.parent.style if node.parent is not None else None
+    key = (parent_style, matched, node.attributes.get("style"))
+    computed = cache.get(key)
+    if computed is None:
+        props = dict(INITIAL_STYLE)
+        for i in matched:
+            props.update(rules[i][1])
+        props.update(node.compute_style())
+        for i in matched:
+            body = rules[i][1]
+            for prop in getattr(body, "important", ()):
+                props[prop] = body[prop]
+        for (prop, default) in INHERITED_PROPERTIES:
+            if prop not in props:
+                props[prop] = default if parent_style is None else parent_style[prop]
+        computed = cache[key] = intern_style(props)
+    if computed is not node.style:
+        node.style = computed
+        node.mark_layout_dirty()
+    node.style_dirty = False
+
+def style(node, rules, cache=None):
     if not isinstance(node, ElementNode): return
-    rules.sort(key=lambda x: x[0].score())
-    for selector, pairs in rules:
-        if selector.matches(node):
-            for property in pairs:
-                node.style[property] = pairs[property]
-    for property, value in node.compute_style().items():
-        node.style[property] = value
-    for (prop, defautl) in INHERITED_PROPERTIES:
-        if prop not in node.style:
-            if node.parent is None:
-                node.style[prop] = default
-            else:
-                node.style[prop] = node.parent.style[prop]
+    if cache is None:
+        if not isinstance(rules, RuleIndex): rules = RuleIndex(rules)
+        # (parent style, matched rules, inline style) -> ComputedStyle, for this pass
+        cache = {}
+    style_node(node, rules, cache)
+    node.child_dirty = False
     for child in node.children:
-        style(child, rules)
+        style(child, rules, cache)
 
+def restyle(node, rules, cache=None, parent_changed=False):
+    # Like style, but only visits dirty elements, the paths down to them, and
+    # descendants whose parent's computed style actually changed
+    if not isinstance(node, ElementNode): return
+    if cache is None:
+        if not isinstance(rules, RuleIndex): rules = RuleIndex(rules)
+        cache = {}
+    changed = False
+    if node.style_dirty or parent_changed:
+        old = node.style
+        style_node(node, rules, cache)
+        changed = node.style is not old
+    if changed or node.child_dirty:
+        node.child_dirty = False
+        for child in node.children:
+            restyle(child, rules, cache, changed)
@@ -0,0 +1,20 @@
+import os
+import tempfile
+import unittest
+from cache import HTTPCache
+
+class DiskCacheTest(unittest.TestCase):
+    def test_damaged_entries_are_skipped(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name, text in [("empty.json", "{}"), ("list.json", "[1, 2]"), ("bad.json", "not json"),
+                               ("old.json", '{"url": "x", "headers": 5, "body": "", "stored": 0, "last_used": 0}')]:
+                with open(os.path.join(directory, name), "w") as f:
+                    f.write(text)
+            cache = HTTPCache(directory=directory)
+            self.assertEqual(len(cache.entries), 0)
+            cache.store("http://example.org:80/", {"cache-control": "max-age=60"}, "hello")
+            self.assertEqual(HTTPCache(directory=directory).lookup("http://example.org:80/").body, "hello")
+            self.assertFalse([name for name in os.listdir(directory) if name.endswith(".tmp")])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import http.server
+import threading
+import unittest
+from cache import HTTPCache
+from network import ConnectionPool, request, request_stream
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b"hello" if self.path == "/" else b""
+        self.send_response(200 if self.path == "/" else 404)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ConnectionReuseTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.port = self.server.server_address[1]
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path):
+        return request("GET", "127.0.0.1", self.port, path, pool=self.pool, cache=HTTPCache())
+
+    def test_request_after_discarding_reused_connection(self):
+        self.assertEqual(self.get("/")[1], "hello")
+        # The 404 arrives on the reused socket, which is then thrown away
+        with self.assertRaises(AssertionError):
+            self.get("/missing")
+        self.assertEqual(self.get("/")[1], "hello")
+
+    def test_request_after_abandoning_body(self):
+        self.assertEqual(self.get("/")[1], "hello")
+        headers, chunks = request_stream("GET", "127.0.0.1", self.port, "/", pool=self.pool, cache=HTTPCache())
+        chunks.close()
+        self.assertEqual(self.get("/")[1], "hello")
+
+if __name__ == "__main__":
+    unittest.main()
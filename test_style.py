@@ -0,0 +1,47 @@
+import unittest
+from style import parse_css, css_declarations
+
+def rules(source):
+    return [(type(selector).__name__, getattr(selector, "tag", None) or getattr(selector, "cls", None)
+             or getattr(selector, "id", None), dict(body))
+            for selector, body in parse_css(source).rules]
+
+def names(source):
+    return sorted(name for kind, name, body in rules(source))
+
+class ParseCSSTest(unittest.TestCase):
+    def test_rule_after_at_rule_block(self):
+        self.assertEqual(names("@media print { p { color: red } } div { color: green }"), ["div"])
+        self.assertEqual(names("@font-face { font-family: x; src: url(x.woff) } p { color: red }"), ["p"])
+        self.assertEqual(names("@supports (display: grid) { @media screen { a { b: c } } } em { color: red }"), ["em"])
+
+    def test_statement_at_rules(self):
+        self.assertEqual(names('@charset "utf-8"; @import url("a;b.css"); p { color: red }'), ["p"])
+
+    def test_comments(self):
+        self.assertEqual(names("/* p { color: red } */ div /* x */ { color: /* } */ green }"), ["div"])
+        self.assertEqual(rules("p { content: '/* kept */' }")[0][2], {"content": "'/* kept */'"})
+
+    def test_comma_selectors(self):
+        parsed = rules("h1, .note ,#top { color: red }")
+        self.assertEqual(sorted(name for kind, name, body in parsed), ["h1", "note", "top"])
+        self.assertTrue(all(body == {"color": "red"} for kind, name, body in parsed))
+
+    def test_important(self):
+        s = "color: red !important; color: blue; margin: 0 ! IMPORTANT"
+        body = css_declarations(s, 0, len(s))
+        self.assertEqual(dict(body), {"color": "red", "margin": "0"})
+        self.assertEqual(body.important, {"color", "margin"})
+
+    def test_quoted_semicolons_and_braces(self):
+        parsed = rules("p { content: 'a;b}'; color: red } div { font-family: \"x;y\" }")
+        self.assertEqual(parsed[0][2], {"content": "'a;b}'", "color": "red"})
+        self.assertEqual(parsed[1][2], {"font-family": '"x;y"'})
+
+    def test_url_with_semicolon(self):
+        s = "background: url(data:image/png;base64,AAAA); color: red"
+        self.assertEqual(dict(css_declarations(s, 0, len(s))),
+                         {"background": "url(data:image/png;base64,AAAA)", "color": "red"})
+
+if __name__ == "__main__":
+    unittest.main()